@@ -1,196 +1,694 @@
 import asyncio
 import aiohttp
+import aiofiles
+import httpx
 import os
+import io
 import json
+import orjson
+import hashlib
+import shelve
 import re
 import logging
-from openai import OpenAI
+import logging.handlers
+import queue
+import atexit
+import threading
+from openai import OpenAI, AsyncOpenAI, RateLimitError
 from collections import deque
-from typing import List, Dict
+from typing import List, Dict, Tuple, Iterable, Optional, TextIO
 from datetime import date
 import time
 
+try:
+    # libuv-based event loop: lower per-event overhead with many concurrent HTTP requests (Linux/macOS only)
+    import uvloop
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
+try:
+    # More accurate token counts for history trimming; falls back to a character-based estimate
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+try:
+    # HTTP/2 for the OpenRouter client: concurrent analysis calls are multiplexed over one connection
+    import h2
+    HAS_H2 = True
+except ImportError:
+    HAS_H2 = False
+
+try:
+    # Non-blocking DNS resolution for aiohttp instead of the default thread-pool resolver
+    import aiodns
+    HAS_AIODNS = True
+except ImportError:
+    HAS_AIODNS = False
+
 PERPLEXITY_API_KEY = os.environ.get("PERPLEXITY_API_KEY")
 OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY")
 RESEARCH_REPORT_FILE = "research_report.md"
+REPORT_FAILED_TEXT = "# Research Report\nGeneration failed due to internal error"
 SEARCH_RESULTS_FILE = "search_results.md"
+SEARCH_RESULTS_JSONL_FILE = "search_results.jsonl"
 SEARCH_RESULT_FILE_WITH_GLOBAL_CITATIONS = "search_results_with_global_citations.md"
 DEFAULT_MODEL = "google/gemini-2.0-flash-001"
 ANALYSIS_MODEL = "deepseek/deepseek-r1"
 WRITING_MODEL = "google/gemini-2.0-flash-001"
 MODEL_ENDPOINT = "https://openrouter.ai/api/v1"
+MAX_CONCURRENT_SUB_QUESTIONS = 5
+HTTP_CONNECTION_LIMIT = 300
+HTTP_CONNECTION_LIMIT_PER_HOST = 75
+HTTP_TIMEOUT = 180
+OPENROUTER_MAX_CONNECTIONS = 100
+OPENROUTER_MAX_KEEPALIVE_CONNECTIONS = 50
+PPLX_MAX_CONCURRENCY = int(os.environ.get("PPLX_MAX_CONCURRENCY", 10))
+OPENROUTER_MAX_CONCURRENCY = int(os.environ.get("OPENROUTER_MAX_CONCURRENCY", 8))
+# Requests per minute allowed per provider (0 disables the limit)
+PPLX_RPM = int(os.environ.get("PPLX_RPM", 50))
+OPENROUTER_RPM = int(os.environ.get("OPENROUTER_RPM", 0))
+# Batching analyses only saves requests per minute and costs latency, so it is off unless an OpenRouter RPM cap is set
+ANALYSIS_BATCH_WINDOW = 0.5
+ANALYSIS_BATCH_SIZE = 5 if OPENROUTER_RPM else 1
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+OPENROUTER_HEADERS = {
+    "HTTP-Referer": "https://github.com/justinhuang0208/deep_research_with_sonar",
+    "X-Title": "Deep Research with Sonar"
+}
+# Model prefixes that need explicit cache_control breakpoints for prompt caching
+PROMPT_CACHE_MODEL_PREFIXES = ("anthropic/",)
+MAX_HISTORY_TOKENS = 16000
+CHARS_PER_TOKEN = 4
+CACHE_DIR = os.path.expanduser("~/.cache/deep_research")
+CACHE_FILE = os.path.join(CACHE_DIR, "responses")
+CACHE_TTL = 24 * 60 * 60
+# Seconds a key is skipped after the provider rate-limits it
+API_KEY_COOLDOWN = 60
+
+def parse_api_keys(keys_env: str, single_key: Optional[str]) -> List[str]:
+    """Read a comma-separated key list from keys_env, falling back to the single key."""
+    keys = [key.strip() for key in os.environ.get(keys_env, "").split(",") if key.strip()]
+    return keys or ([single_key] if single_key else [])
+
+class KeyPool:
+    """Round-robin over API keys, skipping keys that are cooling down after a rate limit."""
+
+    def __init__(self, keys: List[str], cooldown: float = API_KEY_COOLDOWN):
+        self._keys = deque(keys)
+        self.cooldown = cooldown
+        self._blocked_until = {}
+        self.rate_limited_counts = {key: 0 for key in keys}
+
+    def __bool__(self):
+        return bool(self._keys)
+
+    def next(self) -> Optional[str]:
+        """Return the next key that is not cooling down, or the one available soonest if all are."""
+        if not self._keys:
+            return None
+        now = time.monotonic()
+        for _ in range(len(self._keys)):
+            key = self._keys[0]
+            self._keys.rotate(-1)
+            if self._blocked_until.get(key, 0) <= now:
+                return key
+        return min(self._keys, key=lambda k: self._blocked_until.get(k, 0))
+
+    def quarantine(self, key: str):
+        """Skip key for the cooldown period after it was rate limited."""
+        self.rate_limited_counts[key] = self.rate_limited_counts.get(key, 0) + 1
+        self._blocked_until[key] = time.monotonic() + self.cooldown
+
+def json_schema_format(name: str, schema: Dict) -> Dict:
+    """Build a strict json_schema response_format for structured output."""
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+TASK_PLAN_FORMAT = json_schema_format("task_plan", {
+    "type": "object",
+    "properties": {
+        "sub_questions": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "question": {"type": "string"},
+                    "query": {"type": "array", "items": {"type": "string"}}
+                },
+                "required": ["question", "query"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["sub_questions"],
+    "additionalProperties": False
+})
+
+SEARCH_ANALYSIS_FORMAT = json_schema_format("search_analysis", {
+    "type": "object",
+    "properties": {
+        "analyses": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "sub_question_id": {"type": "integer"},
+                    "missing_info": {"type": "string"},
+                    "new_query": {"type": "array", "items": {"type": "string"}}
+                },
+                "required": ["sub_question_id", "missing_info", "new_query"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["analyses"],
+    "additionalProperties": False
+})
+
+PERPLEXITY_KEYS = KeyPool(parse_api_keys("PERPLEXITY_API_KEYS", PERPLEXITY_API_KEY))
+OPENROUTER_KEYS = KeyPool(parse_api_keys("OPENROUTER_API_KEYS", OPENROUTER_API_KEY))
 
 client = OpenAI(
   base_url="https://openrouter.ai/api/v1",
-  api_key=OPENROUTER_API_KEY,
+  api_key=OPENROUTER_KEYS.next(),
+  default_headers=OPENROUTER_HEADERS,
+)
+
+aclient = AsyncOpenAI(
+  base_url=MODEL_ENDPOINT,
+  api_key=OPENROUTER_KEYS.next(),
+  default_headers=OPENROUTER_HEADERS,
+  http_client=httpx.AsyncClient(http2=HAS_H2, limits=httpx.Limits(
+      max_connections=OPENROUTER_MAX_CONNECTIONS,
+      max_keepalive_connections=OPENROUTER_MAX_KEEPALIVE_CONNECTIONS
+  )),
 )
 
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Matches a single "[1]" or "[1, 2]" citation marker; "[1][2]" is matched once per bracket
+CITE_TOKEN_RE = re.compile(r'\[(\d+(?:,\s*\d+)*)\]')
+JSON_BLOCK_RE = re.compile(r'```json\n(.*?)\n```', re.DOTALL)
+WHITESPACE_RE = re.compile(r'\s+')
+
+# Log records are handed to a queue and written by a listener thread, so concurrent searches never block on stdout
+_log_queue = queue.SimpleQueue()
+_console_handler = logging.StreamHandler()
+_console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+log_listener = logging.handlers.QueueListener(_log_queue, _console_handler)
+_queue_handler = logging.handlers.QueueHandler(_log_queue)
+# Only the console handler adds the timestamp and level; the queue handler must pass the bare message through
+_queue_handler.setFormatter(logging.Formatter('%(message)s'))
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
+class RateLimiter:
+    """Token bucket allowing at most `rate` requests per `period` seconds, used as an async context manager."""
+
+    def __init__(self, rate: int, period: float = 60.0):
+        self.rate = rate
+        self.period = period
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        if self.rate <= 0:
+            return self
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.period)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return self
+                await asyncio.sleep((1 - self._tokens) * self.period / self.rate)
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+# Per-provider limits on in-flight requests and requests per minute, so concurrent searches stay under each provider's rate limit
+PPLX_SEM = asyncio.Semaphore(PPLX_MAX_CONCURRENCY)
+OR_SEM = asyncio.Semaphore(OPENROUTER_MAX_CONCURRENCY)
+PPLX_LIMITER = RateLimiter(PPLX_RPM)
+OR_LIMITER = RateLimiter(OPENROUTER_RPM)
+
+# Normalized query -> search task, shared by all sub-questions so a query is only searched once per run
+SEARCH_TASKS: Dict[str, asyncio.Task] = {}
+
+def normalize_query(query: str) -> str:
+    """Normalize a search query for deduplication (insensitive to case, whitespace and trailing punctuation)."""
+    return WHITESPACE_RE.sub(" ", query.casefold()).strip().rstrip("?.!").rstrip()
+
+_token_encoding = None
+_token_encoding_loaded = False
+
+def get_token_encoding():
+    """Load tiktoken's cl100k_base encoding on first use, or return None if it is unavailable.
+
+    tiktoken downloads the encoding on first use, so a network failure must not break the script.
+    """
+    global _token_encoding, _token_encoding_loaded
+    if not _token_encoding_loaded:
+        _token_encoding_loaded = True
+        if tiktoken is not None:
+            try:
+                _token_encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception as e:
+                logger.warning(f"Failed to load tiktoken encoding, estimating tokens from characters: {e}")
+    return _token_encoding
+
+def estimate_tokens(message: Dict) -> int:
+    """Estimate the token count of a chat message.
+
+    The configured models use their own tokenizers, so this is only an approximation either way: cl100k_base is used
+    when available because it tracks BPE tokenizers more closely than CHARS_PER_TOKEN, which is the fallback.
+    """
+    content = message["content"] or ""
+    encoding = get_token_encoding()
+    if encoding is not None:
+        return len(encoding.encode(content, disallowed_special=())) + 4
+    return len(content) // CHARS_PER_TOKEN + 4
+
+def trim_history(history: list, max_tokens: int = MAX_HISTORY_TOKENS) -> list:
+    """Keep the leading system message, the last message and the most recent turns that fit into max_tokens.
+
+    The kept turns always start with a user message, so user/assistant alternation is preserved.
+    history itself is returned, without copying, when it already fits.
+    """
+    sizes = [estimate_tokens(m) for m in history]
+    head = 1 if history and history[0]["role"] == "system" else 0
+    if sum(sizes) <= max_tokens or len(history) <= head + 1:
+        return history
+    budget = max_tokens - sum(sizes[:head]) - sizes[-1]
+    start = len(history) - 1
+    while start > head and budget >= sizes[start - 1]:
+        start -= 1
+        budget -= sizes[start]
+    while start < len(history) - 1 and history[start]["role"] != "user":
+        start += 1
+    return history[:head] + history[start:]
+
+def with_prompt_cache(messages: list, model: str) -> list:
+    """Mark the system prompt as a prompt-cache breakpoint for models that need explicit cache_control.
+
+    Other providers on OpenRouter (e.g. Gemini, DeepSeek) cache repeated prefixes automatically.
+    """
+    if not model.startswith(PROMPT_CACHE_MODEL_PREFIXES) or not messages or messages[0]["role"] != "system":
+        return messages
+    system = {
+        "role": "system",
+        "content": [{"type": "text", "text": messages[0]["content"], "cache_control": {"type": "ephemeral"}}]
+    }
+    return [system] + messages[1:]
+
+def cache_key(model: str, messages: list, temperature: float, namespace: str = "", response_format: Optional[Dict] = None) -> str:
+    """Build the response cache key from everything that determines a completion.
+
+    namespace separates derived entries (e.g. parsed task plans) from raw responses to the same messages.
+    """
+    payload = orjson.dumps(
+        {"namespace": namespace, "model": model, "messages": messages, "temperature": temperature, "response_format": response_format},
+        option=orjson.OPT_SORT_KEYS
+    )
+    return hashlib.sha256(payload).hexdigest()
+
+# Serializes shelve access: async callers reach the cache from worker threads
+_cache_lock = threading.Lock()
+_cache_pruned = False
+
+def is_expired(entry) -> bool:
+    """Whether a cache entry is malformed or older than CACHE_TTL."""
+    return not isinstance(entry, dict) or time.time() - entry.get("time", 0) > CACHE_TTL
+
+def cache_get(key: str):
+    """Return the cached response for key, or None on a miss. An expired entry found here is deleted."""
+    try:
+        with _cache_lock:
+            with shelve.open(CACHE_FILE, flag="r") as cache:
+                entry = cache.get(key)
+            if entry is not None and is_expired(entry):
+                with shelve.open(CACHE_FILE) as cache:
+                    del cache[key]
+                return None
+    except Exception:
+        return None
+    return None if entry is None else entry["value"]
+
+def cache_set(key: str, value):
+    """Store a response in the on-disk cache, pruning expired entries on the first write of each run."""
+    global _cache_pruned
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with _cache_lock:
+            with shelve.open(CACHE_FILE) as cache:
+                if not _cache_pruned:
+                    _cache_pruned = True
+                    for expired_key in [k for k in cache.keys() if is_expired(cache.get(k))]:
+                        del cache[expired_key]
+                cache[key] = {"time": time.time(), "value": value}
+    except Exception as e:
+        logger.warning(f"Failed to write response cache: {e}")
+
 def call_openrouter(prompt: str,
                     history: list,
                     model: str = DEFAULT_MODEL,
                     max_retries: int = 3,
-                    retry_delay: float = 1.0) -> str:
-    """Call the OpenRouter API with the given prompt and history."""
+                    retry_delay: float = 1.0,
+                    cache: bool = True,
+                    stream_to: Optional[TextIO] = None,
+                    response_format: Optional[Dict] = None) -> str:
+    """Call the OpenRouter API with the given prompt and history.
+
+    When stream_to is given, the completion is streamed and written to that file as it is generated.
+    response_format requests structured (JSON) output from models that support it.
+    """
+
+    history.append({"role": "user", "content": prompt})
+    messages = trim_history(history)
+    extra_args = {"response_format": response_format} if response_format else {}
+    key = cache_key(model, messages, 1, response_format=response_format)
+    if cache:
+        cached = cache_get(key)
+        if cached is not None:
+            history.append({"role": "assistant", "content": cached})
+            if stream_to is not None:
+                stream_to.write(cached)
+            return cached
 
     for attempt in range(1, max_retries + 1):
+        api_key = OPENROUTER_KEYS.next()
         try:
-            history.append({"role": "user", "content": prompt})
-            response = client.chat.completions.create(
-                model=model,
-                messages=history + [{"role": "user", "content": prompt}],
-                temperature=1
-            )
-            if not response.choices or not hasattr(response.choices[0], "message"):
-                return ""
+            if stream_to is not None:
+                # Discard partial output of a failed attempt
+                stream_to.seek(0)
+                stream_to.truncate()
+                chunks = []
+                for chunk in client.with_options(api_key=api_key).chat.completions.create(
+                    model=model,
+                    messages=with_prompt_cache(messages, model),
+                    temperature=1,
+                    stream=True,
+                    **extra_args
+                ):
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        chunks.append(chunk.choices[0].delta.content)
+                        stream_to.write(chunks[-1])
+                if not chunks:
+                    return ""
+                result = "".join(chunks)
+            else:
+                response = client.with_options(api_key=api_key).chat.completions.create(
+                    model=model,
+                    messages=with_prompt_cache(messages, model),
+                    temperature=1,
+                    **extra_args
+                )
+                if not response.choices or not hasattr(response.choices[0], "message"):
+                    return ""
+                result = response.choices[0].message.content
 
-            result = response.choices[0].message.content
             history.append({"role": "assistant", "content": result})
+            if cache and result:
+                cache_set(key, result)
             return result
 
         except Exception as e:
+            if isinstance(e, RateLimitError):
+                OPENROUTER_KEYS.quarantine(api_key)
             logger.error(f"OpenRouter call failed on attempt {attempt}/{max_retries}: {e}")
             if attempt < max_retries:
                 time.sleep(retry_delay)
             else:
+                if stream_to is not None:
+                    # Don't leave the partial output of the last failed attempt behind
+                    stream_to.seek(0)
+                    stream_to.truncate()
                 return ""
 
-async def call_perplexity_async(session: aiohttp.ClientSession, query: str, model: str = "sonar") -> Dict:
-    """Asyncornously call Perplexity API."""
-    try:
+async def call_openrouter_async(prompt: str,
+                                history: list,
+                                model: str = DEFAULT_MODEL,
+                                max_retries: int = 3,
+                                retry_delay: float = 1.0,
+                                cache: bool = True,
+                                response_format: Optional[Dict] = None) -> str:
+    """Asynchronously call the OpenRouter API without blocking the event loop.
+
+    The completion is streamed, so control returns to the event loop on every chunk while the model is generating.
+    """
+
+    history.append({"role": "user", "content": prompt})
+    messages = trim_history(history)
+    extra_args = {"response_format": response_format} if response_format else {}
+    key = cache_key(model, messages, 1, response_format=response_format)
+    if cache:
+        cached = await asyncio.to_thread(cache_get, key)
+        if cached is not None:
+            history.append({"role": "assistant", "content": cached})
+            return cached
+
+    for attempt in range(1, max_retries + 1):
+        api_key = OPENROUTER_KEYS.next()
+        try:
+            chunks = []
+            async with OR_LIMITER, OR_SEM:
+                stream = await aclient.with_options(api_key=api_key).chat.completions.create(
+                    model=model,
+                    messages=with_prompt_cache(messages, model),
+                    temperature=1,
+                    stream=True,
+                    **extra_args
+                )
+                async for chunk in stream:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        chunks.append(chunk.choices[0].delta.content)
+            if not chunks:
+                return ""
+
+            result = "".join(chunks)
+            history.append({"role": "assistant", "content": result})
+            if cache and result:
+                await asyncio.to_thread(cache_set, key, result)
+            return result
+
+        except Exception as e:
+            if isinstance(e, RateLimitError):
+                OPENROUTER_KEYS.quarantine(api_key)
+            logger.error(f"OpenRouter call failed on attempt {attempt}/{max_retries}: {e}")
+            if attempt < max_retries:
+                await asyncio.sleep(retry_delay * 2 ** (attempt - 1))
+            else:
+                return ""
+
+async def create_http_session() -> aiohttp.ClientSession:
+    """Create the long-lived HTTP session shared by every search in a run."""
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_CONNECTION_LIMIT,
+        limit_per_host=HTTP_CONNECTION_LIMIT_PER_HOST,
+        ttl_dns_cache=600,
+        keepalive_timeout=60,
+        enable_cleanup_closed=True,
+        resolver=aiohttp.AsyncResolver() if HAS_AIODNS else None
+    )
+    return aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT))
+
+async def call_perplexity_async(session: aiohttp.ClientSession,
+                                query: str,
+                                model: str = "sonar",
+                                max_retries: int = 3,
+                                retry_delay: float = 1.0,
+                                cache: bool = True) -> Dict:
+    """Asyncornously call Perplexity API, retrying with exponential backoff on rate limits and server errors."""
+    content = f"""Your job is to use the search tool to provide accurate and detailed search results. Current date: {date.today()}.
+            The citation format is [number] and should be used to reference the search results in the final answer, especially the statment of numbers.
+            - NO SPACE between the last word and the citation, and ALWAYS use brackets. Only use this format to cite search results. NEVER include a References section at the end of your answer.
+            Provide detailed explanations and examples to support your answer.
+            If the search results are empty or unhelpful, answer the query as well as you can with existing knowledge.
+            Make users can understand your arguments clearly without having to click on citations.
+            You MUST ADHERE TO the following formatting instructions:
+            - Use markdown to format paragraphs, lists, tables, and quotes whenever possible.
+            - Use headings level 3 and 4 to separate sections of your response, like "## Header", but NEVER start an answer with a heading or title of any kind.
+            - NEVER write URLs or links"""
+
+    payload = {
+        "model": model,
+        "messages": [
+            {"role": "system", "content": content},
+            {"role": "user", "content": query}
+        ],
+        "temperature": 1
+    }
+
+    # Key on the normalized query so rephrasings differing only in case or whitespace share an entry
+    key = cache_key(model, [payload["messages"][0], {"role": "user", "content": normalize_query(query)}], payload["temperature"])
+    if cache:
+        cached = await asyncio.to_thread(cache_get, key)
+        if cached is not None:
+            return {"query": query, **cached}
+
+    for attempt in range(1, max_retries + 1):
+        api_key = PERPLEXITY_KEYS.next()
         headers = {
-            "Authorization": f"Bearer {PERPLEXITY_API_KEY}",
+            "Authorization": f"Bearer {api_key}",
             "Content-Type": "application/json"
         }
-
-        content = f"""Your job is to use the search tool to provide accurate and detailed search results. Current date: {date.today()}.
-                The citation format is [number] and should be used to reference the search results in the final answer, especially the statment of numbers.
-                - NO SPACE between the last word and the citation, and ALWAYS use brackets. Only use this format to cite search results. NEVER include a References section at the end of your answer.
-                Provide detailed explanations and examples to support your answer.
-                If the search results are empty or unhelpful, answer the query as well as you can with existing knowledge.
-                Make users can understand your arguments clearly without having to click on citations.
-                You MUST ADHERE TO the following formatting instructions:
-                - Use markdown to format paragraphs, lists, tables, and quotes whenever possible.
-                - Use headings level 3 and 4 to separate sections of your response, like "## Header", but NEVER start an answer with a heading or title of any kind.
-                - NEVER write URLs or links"""
-
-        payload = {
-            "model": model,
-            "messages": [
-                {"role": "system", "content": content},
-                {"role": "user", "content": query}
-            ],
-            "temperature": 1
-        }
-
-        async with session.post("https://api.perplexity.ai/chat/completions", headers=headers, json=payload, timeout=120) as response:
-            response.raise_for_status()
-            result = await response.json()
+        try:
+            async with PPLX_LIMITER, PPLX_SEM:
+                async with session.post("https://api.perplexity.ai/chat/completions", headers=headers, json=payload) as response:
+                    response.raise_for_status()
+                    result = orjson.loads(await response.read())
             content = result['choices'][0]['message']['content']
             # content = re.sub(r"<think>.*?</think>", "", content, flags=re.DOTALL)
+            citations = result.get('citations', [])
+            if cache:
+                await asyncio.to_thread(cache_set, key, {"content": content, "citations": citations})
             return {
                 "query": query,
                 "content": content,
-                "citations": result.get('citations', [])
+                "citations": citations
             }
 
-    except Exception as e:
-        logger.error(f"Perplexity search failed for query '{query}': {str(e)}")
-        return {"query": query, "content": f"Search Error: {str(e)}", "citations": []}
-
-def save_search_result(query: str, result: Dict):
-    """Save search result to file."""
-    with open(SEARCH_RESULTS_FILE, "a", encoding="utf-8") as f:
-        f.write(f"# {query}\n")
-        f.write("## content\n")
-        f.write(result["content"] + "\n")
-        f.write("## citations\n")
-        if result["citations"]:
-            for i, url in enumerate(result["citations"], 1):
-                f.write(f"{i}. {url}\n")
-        else:
-            f.write("No citations available\n")
-        f.write("***\n\n")
+        except aiohttp.ClientResponseError as e:
+            if e.status == 429:
+                PERPLEXITY_KEYS.quarantine(api_key)
+            if e.status in RETRYABLE_STATUS_CODES and attempt < max_retries:
+                retry_after = (e.headers or {}).get("Retry-After")
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else retry_delay * 2 ** (attempt - 1)
+                logger.warning(f"Perplexity returned {e.status} for query '{query}', retrying in {delay}s ({attempt}/{max_retries})")
+                await asyncio.sleep(delay)
+                continue
+            logger.error(f"Perplexity search failed for query '{query}': {str(e)}")
+            return {"query": query, "content": f"Search Error: {str(e)}", "citations": []}
 
-def process_citations():
-    """Processes citations, creates a global list, and replaces in-text markers."""
+        except Exception as e:
+            logger.error(f"Perplexity search failed for query '{query}': {str(e)}")
+            return {"query": query, "content": f"Search Error: {str(e)}", "citations": []}
 
-    with open(SEARCH_RESULTS_FILE, "r", encoding="utf-8") as f:
-        content = f.read()
+def format_search_result(query: str, result: Dict) -> str:
+    """Render one search result as a markdown section of the search results file."""
+    parts = [f"# {query}\n", "## content\n", result["content"] + "\n", "## citations\n"]
+    if result["citations"]:
+        parts.extend(f"{i}. {url}\n" for i, url in enumerate(result["citations"], 1))
+    else:
+        parts.append("No citations available\n")
+    parts.append("***\n\n")
+    return "".join(parts)
 
-    sections = re.split(r'(?=^# .+$)', content, flags=re.MULTILINE)
+class SearchResultsWriter:
+    """Keeps the markdown and JSONL search results files open for the whole search stage.
 
-    global_citations = []
-    current_global_id = 0
-    citation_map_all = {}  # Local ID -> Global ID
-    used_global_ids = set()  # Keep track of used global IDs
+    Used as an async context manager; concurrent writers are serialized with a lock, and every batch
+    is flushed to disk once written so an interrupted run keeps the results saved so far.
+    """
 
-    # --- PASS 1: Extract Citations and Build Mapping ---
-    for i, section in enumerate(sections):
-        if not section.strip():
-            continue
+    async def __aenter__(self):
+        self.records = []  # Every saved result, in write order, for citation processing without a read-back
+        self._lock = asyncio.Lock()
+        self._markdown = await aiofiles.open(SEARCH_RESULTS_FILE, "a", encoding="utf-8")
+        self._jsonl = await aiofiles.open(SEARCH_RESULTS_JSONL_FILE, "ab")
+        return self
 
-        citations_match = re.search(r'## citations\n([\s\S]+?)(?=\n##|\Z)', section)
-        if not citations_match:
-            continue
+    async def __aexit__(self, *exc_info):
+        await self._markdown.close()
+        await self._jsonl.close()
+        return False
 
-        local_citations = re.findall(r'\d+\.\s+(https?://\S+)', citations_match.group(1))
+    async def write(self, results: List[Dict]):
+        """Append a batch of search results to both files with a single write and flush each."""
+        if not results:
+            return
+        records = [{"query": r["query"], "content": r["content"], "citations": r["citations"]} for r in results]
+        markdown = "".join(format_search_result(record["query"], record) for record in records)
+        jsonl = b"".join(orjson.dumps(record) + b"\n" for record in records)
+        async with self._lock:
+            self.records.extend(records)
+            await self._markdown.write(markdown)
+            await self._jsonl.write(jsonl)
+            await self._markdown.flush()
+            await self._jsonl.flush()
 
-        for local_id, url in enumerate(local_citations, start=1):
-            current_global_id += 1
-            global_citations.append(f"{current_global_id}. {url}")
-            citation_map_all[f"{i+1}-{local_id}"] = current_global_id
+def read_search_records() -> Iterable[Dict]:
+    """Stream the saved search records from the JSONL results file."""
+    with open(SEARCH_RESULTS_JSONL_FILE, "rb") as f:
+        for line in f:
+            if line.strip():
+                yield orjson.loads(line)
 
-        # Remove the original citation section:
-        sections[i] = re.sub(r'## citations\n[\s\S]+?(?=\n##|\Z)', '', section)
+def process_citations(records: Optional[Iterable[Dict]] = None):
+    """Processes citations, creates a global list, and replaces in-text markers.
 
+    Search records are processed one at a time, taken from memory when given or streamed from the
+    JSONL results file otherwise, and each rewritten section is written to the output file as soon
+    as it is processed.
+    """
+    if records is None:
+        records = read_search_records()
 
-    # --- PASS 2: Replace Citation Markers and Track Usage ---
-    for i, section in enumerate(sections):
-        if not section.strip():
-            continue
+    current_global_id = 0
+    used_global_citations = []
+    processed_content = io.StringIO()
 
-        def replace_citation(match):
-            original_text = match.group(0)
+    with open(SEARCH_RESULT_FILE_WITH_GLOBAL_CITATIONS, "w", encoding="utf-8") as out:
+        for record in records:
+            citations = record["citations"]
+            # Local ID n of this section maps to global ID offset + n
+            offset = current_global_id
+            current_global_id += len(citations)
+            used_local_ids = set()
 
-            local_ids_str = re.findall(r'\d+', original_text)
-            local_ids = [int(id_str) for id_str in local_ids_str]
-            
-            global_ids = []
-            for local_id in local_ids:
-                key = f"{i+1}-{local_id}"
-                if key in citation_map_all:
-                    global_id = citation_map_all[key]
-                    global_ids.append(str(global_id))
-                    used_global_ids.add(global_id)
-            
-            if not global_ids:
-                return original_text
+            def replace_citation(match):
+                global_ids = []
+                for id_str in match.group(1).split(","):
+                    local_id = int(id_str)
+                    if 1 <= local_id <= len(citations):
+                        global_ids.append(str(offset + local_id))
+                        used_local_ids.add(local_id)
 
-            replacement = f"[{']['.join(global_ids)}]"
-            return replacement
+                if not global_ids:
+                    return match.group(0)
+                return f"[{']['.join(global_ids)}]"
 
-        updated_section = re.sub(r'\[\d+(?:,\s*\d+)*\]', replace_citation, section)
-        updated_section = re.sub(r'\[\d+(?:\]\[\d+)*\]', replace_citation, updated_section)
-        sections[i] = updated_section
+            # Without citations no marker can be mapped, so skip the scan entirely
+            content = CITE_TOKEN_RE.sub(replace_citation, record["content"]) if citations else record["content"]
+            section = f"# {record['query']}\n## content\n{content}\n"
+            if processed_content.tell():
+                section = "\n" + section
+            out.write(section)
+            processed_content.write(section)
 
+            used_global_citations.extend(
+                f"{offset + local_id}. {citations[local_id - 1]}" for local_id in sorted(used_local_ids)
+            )
 
-    # --- PASS 3: Filter Global Citations ---
-    filtered_global_citations = [
-        citation for citation in global_citations
-        if int(citation.split(".")[0]) in used_global_ids
-    ]
+        processed_global_citation = "\n".join(used_global_citations)
+        out.write("\n\n# Global Citations\n" + processed_global_citation)
 
-    # --- Combine and Add Filtered Global Citations ---
-    processed_content = "\n".join(filter(None, sections))
-    processed_global_citation = "\n".join(filtered_global_citations)
+    return processed_content.getvalue(), processed_global_citation
 
-    with open(SEARCH_RESULT_FILE_WITH_GLOBAL_CITATIONS, "w", encoding="utf-8") as f:
-        f.write(processed_content + "\n\n# Global Citations\n" + processed_global_citation)
+def parse_json_response(response: str):
+    """Parse a JSON reply, accepting both bare JSON (structured output) and a ```json fenced block."""
+    try:
+        return orjson.loads(response)
+    except orjson.JSONDecodeError:
+        json_match = JSON_BLOCK_RE.search(response)
+        if not json_match:
+            raise ValueError("No JSON block found in response")
+        return orjson.loads(json_match.group(1).strip())
 
-    return processed_content, processed_global_citation
+def is_valid_task_plan(plan) -> bool:
+    """Whether a parsed task plan has the shape main_flow relies on: sub_questions of {question: str, query: list[str]}."""
+    if not isinstance(plan, dict) or not isinstance(plan.get("sub_questions"), list):
+        return False
+    return all(
+        isinstance(sub_question, dict)
+        and isinstance(sub_question.get("question"), str)
+        and isinstance(sub_question.get("query"), list)
+        and all(isinstance(q, str) for q in sub_question["query"])
+        for sub_question in plan["sub_questions"]
+    )
 
 def analyze_task(query: str, history: List[Dict]) -> Dict:
     """Task analysis and planning"""
@@ -207,116 +705,263 @@ def analyze_task(query: str, history: List[Dict]) -> Dict:
         ]
     }"""
     
+    full_prompt = f"{prompt}\nResearch topic:{query}"
+    # Memoize the parsed plan rather than the raw reply, so an unparseable reply is never replayed from the cache
+    plan_key = cache_key(ANALYSIS_MODEL, history, 1, namespace="task_plan:" + full_prompt)
+    cached_plan = cache_get(plan_key)
+    if cached_plan is not None:
+        return cached_plan
+
+    # The discussion is needed as context, but the planning turn doesn't belong in the shared history
+    history_length = len(history)
     response = call_openrouter(
-        prompt=f"{prompt}\nResearch topic:{query}",
+        prompt=full_prompt,
         history=history,
-        model=ANALYSIS_MODEL
+        model=ANALYSIS_MODEL,
+        cache=False,
+        response_format=TASK_PLAN_FORMAT
     )
+    del history[history_length:]
     try:
-        json_match = re.search(r'```json\n(.*?)\n```', response, re.DOTALL)
-        if not json_match:
-            raise ValueError("No JSON block found in response")
-            
-        json_str = json_match.group(1)
-        return json.loads(json_str)
+        plan = parse_json_response(response)
     except Exception as e:
         logger.error(f"Failed to parse analysis response: {str(e)}")
         logger.error(f"Problematic response: {response}")
-        return {"sub_questions": []} 
+        return {"sub_questions": []}
+    if not is_valid_task_plan(plan):
+        logger.error(f"Task plan does not match the expected format: {response}")
+        return {"sub_questions": []}
+    cache_set(plan_key, plan)
+    return plan
+
+class AnalysisBatcher:
+    """Collects the per-depth analyses of concurrently running sub-questions and answers them with one OpenRouter call per batch.
+
+    Requests arriving within `window` seconds of each other (or until `max_size` are pending) share a single call,
+    cutting OpenRouter requests per minute by the batch size.
+    """
+
+    def __init__(self, history: List[Dict], main_goal: str, window: float = ANALYSIS_BATCH_WINDOW, max_size: int = ANALYSIS_BATCH_SIZE):
+        self.history = history
+        self.main_goal = main_goal
+        self.window = window
+        self.max_size = max_size
+        self._pending = []  # (sub_question, current_results, future)
+        self._flush_handle = None
+        self._running = set()  # Strong references to in-flight batch calls
 
-async def execute_dynamic_search(sub_question: Dict, history: List[Dict], main_goal, max_search_depth: int) -> Dict:
+    async def analyze(self, sub_question: Dict, current_results: List[str]) -> Dict:
+        """Return the analysis ({"missing_info", "new_query"}) of one sub-question's current search results."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((sub_question, current_results, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, batch: list):
+        sections = "\n".join(
+            f"""## Sub Question {i}:{sub_question['question']}
+            ### Current Search Results:
+            {current_results}"""
+            for i, (sub_question, current_results, _) in enumerate(batch, 1)
+        )
+        analysis_prompt = f"""The main goal of the research is {self.main_goal}.
+            Synthesize the search results of each of the following sub questions:
+            {sections}
+            For each sub question please generate:
+            1. Statement of supplementary search directions needed
+            2. New 1 to 3 search queries based on the statement of suplementary search directions needed, with concisely and detailed describe.
+            Respond according to the following JSON format, with one object per sub question:
+            ```json
+            {{
+                "analyses": [
+                    {{
+                        "sub_question_id": Number of the sub question,
+                        "missing_info": Statement of supplementary search directions needed,
+                        "new_query": ["New Search query"]
+                    }}
+                ]
+            }}
+            ```"""
+        # Memoize the parsed analyses rather than the raw reply, so an unusable reply is never replayed from the cache
+        analyses_key = cache_key(ANALYSIS_MODEL, self.history[:1], 1, namespace="analysis:" + analysis_prompt)
+        analyses = await asyncio.to_thread(cache_get, analyses_key)
+        if analyses is not None:
+            self._resolve(batch, analyses)
+            return
+
+        analyses = {}
+        try:
+            # The analysis prompt is self-contained, so keep its turns out of the shared history
+            analysis_response = await call_openrouter_async(
+                analysis_prompt, self.history[:1], ANALYSIS_MODEL, cache=False, response_format=SEARCH_ANALYSIS_FORMAT
+            )
+            try:
+                parsed = parse_json_response(analysis_response)
+                if isinstance(parsed, dict):
+                    parsed = parsed.get("analyses", [parsed])
+                for a in parsed:
+                    if not isinstance(a, dict):
+                        continue
+                    if not isinstance(a.get("new_query"), list) or not all(isinstance(q, str) for q in a["new_query"]):
+                        logger.warning(f"Batched analysis reply has an invalid new_query: {a.get('new_query')!r}")
+                        continue
+                    if a.get("sub_question_id") is None and len(batch) == 1:
+                        # A single analysis may come back in the unbatched form, without an id
+                        analyses[1] = a
+                        continue
+                    try:
+                        analyses[int(a.get("sub_question_id"))] = a
+                    except (TypeError, ValueError):
+                        logger.warning(f"Batched analysis reply has an invalid sub_question_id: {a.get('sub_question_id')!r}")
+            except ValueError as e:
+                logger.error(f"Failed to parse analysis response: {e}")
+                logger.error(f"Full analysis_response: {analysis_response}")
+        except Exception as e:
+            logger.error(f"Batched analysis failed: {e}")
+
+        if all(i in analyses for i in range(1, len(batch) + 1)):
+            await asyncio.to_thread(cache_set, analyses_key, analyses)
+        self._resolve(batch, analyses)
+
+    @staticmethod
+    def _resolve(batch: list, analyses: Dict):
+        """Hand each pending sub-question its analysis, by 1-based sub_question_id."""
+        for i, (sub_question, _, future) in enumerate(batch, 1):
+            if i not in analyses and analyses:
+                logger.warning(f"Batched analysis reply has no sub_question_id {i}, skipping supplementary search for [{sub_question['question']}]")
+            if not future.done():
+                future.set_result(analyses.get(i, {"new_query": []}))
+
+async def execute_dynamic_search(session: aiohttp.ClientSession, writer: SearchResultsWriter, sub_question: Dict, analyzer: AnalysisBatcher, max_search_depth: int) -> List[str]:
     """Asyncronously execute dynamic search process (integrated result saving)"""
 
     search_queue = deque(sub_question["query"])
     processed = set()
     results = []
 
-    async with aiohttp.ClientSession() as session:
-        for depth in range(max_search_depth + 1):
-            current_results = []
-            tasks = []
-
-            while search_queue:
-                query = search_queue.popleft()
-                if query in processed:
-                    continue
-
-                print(f"Searching [{sub_question['question']}] - {query}")
-                tasks.append(call_perplexity_async(session, query))
-                processed.add(query)
-
-            api_responses = await asyncio.gather(*tasks)
-            for response in api_responses:
-                 save_search_result(response["query"], response)
-                 current_results.append(response["content"])
-                 
-
-            if depth < max_search_depth and current_results:
-                analysis_prompt = f"""The main goal of the research is {main_goal}.
-                ## Sub Question:{sub_question['question']}
-                Synthesize the following results:
-                ## Current Search Results:
-                {current_results}
-                please generate:
-                1. Statement of supplementary search directions needed
-                2. New 1 to 3 search queries based on the statement of suplementary search directions needed, with concisely and detailed describe.
-                Respond according to the following JSON format:
-                ```json
-                {{
-                    "missing_info": Statement of supplementary search directions needed,
-                    "new_query": ["New Search query"]
-                }}
-                ```"""
-                analysis_response = call_openrouter(analysis_prompt, history, ANALYSIS_MODEL)
-                json_match = re.search(r'```json\n(.*?)\n```', analysis_response, re.DOTALL)
-
-                if json_match:
-                    json_string = json_match.group(1).strip()
-                    try:
-                        analysis = json.loads(json_string)
-                        if "new_query" in analysis:
-                            print(f"\n{analysis.get('missing_info', None)} \nAdd supplementary search: {analysis['new_query']}\n")
-                            search_queue.extend(analysis["new_query"])
-                        else:
-                            print(f"\nNo supplementary search needed\n")
-                    except json.JSONDecodeError as e:
-                        logger.error(f"JSONDecodeError: {e}")
-                        logger.error(f"Problematic JSON string: {json_string}")
-                        analysis = {"new_query": []}
-                else:
-                    logger.error("No JSON block found in analysis_response.")
-                    analysis = {"new_query": []}
-                    logger.error(f"Full analysis_response: {analysis_response}")
-
-            results.extend(current_results)
-            if not search_queue:
-                break
+    for depth in range(max_search_depth + 1):
+        current_results = []
+        tasks = []
+        owned_keys = set()  # Searches issued by this sub-question (and so saved by it)
+
+        while search_queue:
+            query = search_queue.popleft()
+            key = normalize_query(query)
+            if key in processed:
+                continue
+            processed.add(key)
+
+            if key in SEARCH_TASKS:
+                # Already searched (or in flight) for another sub-question: reuse its result
+                tasks.append(SEARCH_TASKS[key])
+                continue
+
+            logger.info(f"Searching [{sub_question['question']}] - {query}")
+            task = asyncio.ensure_future(call_perplexity_async(session, query))
+            SEARCH_TASKS[key] = task
+            tasks.append(task)
+            owned_keys.add(key)
+
+        # Save each response as soon as it arrives instead of waiting for the slowest search of this depth
+        for next_done in asyncio.as_completed(tasks):
+            response = await next_done
+            if normalize_query(response["query"]) in owned_keys:
+                await writer.write([response])
+            current_results.append(response["content"])
+
+        if depth < max_search_depth and current_results:
+            analysis = await analyzer.analyze(sub_question, current_results)
+            if analysis.get("new_query"):
+                logger.info(f"{analysis.get('missing_info', None)} - Add supplementary search: {analysis['new_query']}")
+                search_queue.extend(analysis["new_query"])
+            else:
+                logger.info(f"No supplementary search needed for [{sub_question['question']}]")
+
+        results.extend(current_results)
+        if not search_queue:
+            break
     return results
 
-def generate_research_report(main_goal: List[Dict]) -> str:
-    """Generate the final research report (integrated processed content)"""
+async def run_all_subquestions(session: aiohttp.ClientSession, sub_questions: List[Dict], history: List[Dict], main_goal: str, max_search_depth: int) -> List[Dict]:
+    """Run the dynamic search of every sub-question concurrently over a shared session and return the saved search records"""
+
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_SUB_QUESTIONS)
+    analyzer = AnalysisBatcher(history, main_goal)
+    num_sub_questions = len(sub_questions)
+
+    async def run_one(i: int, sub: Dict) -> List[str]:
+        async with semaphore:
+            logger.info(f"Searching sub-question {i+1} of {num_sub_questions}")
+            return await execute_dynamic_search(session, writer, sub, analyzer, max_search_depth)
+
+    async with SearchResultsWriter() as writer:
+        await asyncio.gather(*(run_one(i, sub) for i, sub in enumerate(sub_questions)))
+    return writer.records
+
+def generate_research_report(main_goal: str, search_records: Optional[List[Dict]] = None) -> Tuple[str, str]:
+    """Generate the final research report (integrated processed content), streaming it into the report file"""
 
     try:
-        processed_content, global_citations = process_citations()
-        prompt = """According to the conversation histories between user and assistant, merge the content from all search results, add appropriate text paragraphs, and expand it into an in-depth research report covering all search data.
+        processed_content, global_citations = process_citations(search_records)
+        prompt = """According to the research plan agreed with the user, merge the content from all search results, add appropriate text paragraphs, and expand it into an in-depth research report covering all search data.
                 The report must mention all search results, don't simplify it. The report should be persuasive, explain the cause and effect relationships.
                 Each important argument or data should be accompanied by the corresponding citation number, e.g.: [1][2]. Ensure the citation format is correct and accurate, while ordinary descriptions do not need to be cited."""
-        return call_openrouter(
-            prompt=prompt + "\n" + processed_content,
-            history=main_goal,
-            model=WRITING_MODEL
-        ), global_citations
+        with open(RESEARCH_REPORT_FILE, "w", encoding="utf-8") as f:
+            report = call_openrouter(
+                prompt=f"{prompt}\n## Research plan:\n{main_goal}\n## Search results:\n{processed_content}",
+                history=[],
+                model=WRITING_MODEL,
+                stream_to=f
+            )
+            if not report:
+                raise RuntimeError("The writing model returned no report")
+            f.write("\n\n# Global Citations\n" + global_citations)
+        return report, global_citations
     except Exception as e:
         logger.error(f"Report generation failed: {str(e)}")
-        return "# Research Report\nGeneration failed due to internal error"
+        with open(RESEARCH_REPORT_FILE, "w", encoding="utf-8") as f:
+            f.write(REPORT_FAILED_TEXT)
+        return REPORT_FAILED_TEXT, ""
     
 def organize_search_results(search_results: List[Dict]) -> str:
     """Organize all the search results in the same sub-question"""
     return
 
+def input_while_running(loop: asyncio.AbstractEventLoop, prompt: str) -> str:
+    """Read user input in a worker thread so tasks already scheduled on loop keep running meanwhile.
+
+    The thread is a daemon (not the default executor), so Ctrl-C exits without waiting for input() to return.
+    """
+    future = loop.create_future()
+
+    def read_input():
+        try:
+            line = input(prompt)
+        except Exception as e:
+            loop.call_soon_threadsafe(future.set_exception, e)
+            return
+        loop.call_soon_threadsafe(future.set_result, line)
+
+    threading.Thread(target=read_input, daemon=True).start()
+    return loop.run_until_complete(future)
+
 def main_flow():
     
-    if not (PERPLEXITY_API_KEY or OPENROUTER_API_KEY):
+    if not (PERPLEXITY_KEYS and OPENROUTER_KEYS):
         logger.error("Please set the environment variables PERPLEXITY_API_KEY and OPENROUTER_API_KEY.")
         return
 
@@ -328,19 +973,22 @@ def main_flow():
                         3. Analyze and comment on the current status of the research question to see if there is any content that needs to be supplemented.
                         4. Generate research report: Based on the previous research results and discussions, generate an in-depth research report that meets user expectations."""
     conversation_history = [{"role": "system", "content": system_prompt}]
-    
+
+    # One event loop for the whole run so the HTTP session (and its pooled connections) can be reused across stages
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    session = loop.run_until_complete(create_http_session())
+
     try:
         user_query = input("\nPlease enter the research topic: ")
-        max_search_depth = int(input("Please enter the maximum search depth: "))
+        need_initial_search = input("Need initial search? (y/n): ").lower() == "y"
+        # Run the initial search while the user answers the depth prompt
+        initial_search_task = loop.create_task(call_perplexity_async(session, user_query, "sonar")) if need_initial_search else None
+        max_search_depth = int(input_while_running(loop, "Please enter the maximum search depth: "))
 
-        if input("Need initial search? (y/n): ").lower() == "y":
+        if need_initial_search:
             print("\n===Performing initial search===")
-
-            async def get_initial_search():
-                async with aiohttp.ClientSession() as session:
-                    return await call_perplexity_async(session, user_query, "sonar")
-            
-            init_search_result = asyncio.run(get_initial_search())
+            init_search_result = loop.run_until_complete(initial_search_task)
             init_search = init_search_result['content']
             user_prompt = f"""Discuss the research direction with the user and correct.
                         This is the initial search result for this research topic, 
@@ -360,7 +1008,7 @@ def main_flow():
             else:
                 break
         print("\n")
-        main_goal = list(conversation_history[-1])
+        main_goal = conversation_history[-1]["content"]
         
         # Task Analysis Stage
         print("===Analyzing research tasks===")
@@ -372,26 +1020,29 @@ def main_flow():
         
         # Dynamic Search Stage
         print("\n===Starting to execute in-depth search===")
-        for i, sub in enumerate(task_plan["sub_questions"]):
-            print(f"\n=== Searching sub-question {i+1} of {num_sub_questions} ===")
-            asyncio.run(execute_dynamic_search(sub, conversation_history, main_goal, max_search_depth))
+        search_records = loop.run_until_complete(run_all_subquestions(session, task_plan["sub_questions"], conversation_history, main_goal, max_search_depth))
         
         # Generate Final Report
         print("\n===Generating research report===")
-        report, global_citations = generate_research_report(main_goal)
-        
-        # Save Results
-        with open("research_report.md", "w", encoding="utf-8") as f:
-            f.write(report + "\n\n# Global Citations\n" + global_citations)
-        print(f"\nReport saved to: research_report.md")
+        report, _ = generate_research_report(main_goal, search_records)
+        if report == REPORT_FAILED_TEXT:
+            print("\nReport generation failed, see the log above")
+        else:
+            print(f"\nReport saved to: {RESEARCH_REPORT_FILE}")
         
     except Exception as e:
         logger.error(f"Process execution failed:{str(e)}")
+    finally:
+        loop.run_until_complete(session.close())
+        loop.run_until_complete(aclient.close())
+        loop.close()
 
 if __name__ == "__main__":
     # Clear old files during initialization
     if os.path.exists(SEARCH_RESULTS_FILE):
         os.remove(SEARCH_RESULTS_FILE)
+    if os.path.exists(SEARCH_RESULTS_JSONL_FILE):
+        os.remove(SEARCH_RESULTS_JSONL_FILE)
     if os.path.exists(RESEARCH_REPORT_FILE):
         os.remove(RESEARCH_REPORT_FILE)
     if os.path.exists(SEARCH_RESULT_FILE_WITH_GLOBAL_CITATIONS):